@@ -1,22 +1,45 @@
+import base64
+import logging
 import os
-from typing import List, Optional, Any, Dict
-
-from fastapi import FastAPI, HTTPException, Query
+import re
+import time
+from datetime import datetime, timezone
+from typing import List, Literal, Optional, Any, Dict
+
+import orjson
+import xxhash
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
 
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
 
 from database import db, create_document
 
-app = FastAPI(title="E-Commerce Template API")
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="E-Commerce Template API", default_response_class=ORJSONResponse)
+
+# Starlette compiles this once; set CORS_ORIGIN_REGEX to the deployed frontends
+CORS_ORIGIN_REGEX = os.getenv("CORS_ORIGIN_REGEX")
+if CORS_ORIGIN_REGEX:
+    cors_origins: Dict[str, Any] = {"allow_origin_regex": CORS_ORIGIN_REGEX}
+else:
+    logger.warning("CORS_ORIGIN_REGEX is not set; allowing requests from any origin")
+    cors_origins = {"allow_origins": ["*"]}
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    **cors_origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 
@@ -32,28 +55,155 @@ class PyObjectId(ObjectId):
     def validate(cls, v):
         if isinstance(v, ObjectId):
             return v
-        if not ObjectId.is_valid(v):
+        # ObjectId(None) generates a fresh id instead of failing
+        if not isinstance(v, (str, bytes)):
             raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
+            raise ValueError("Invalid ObjectId")
+
+
+def parse_product_id(product_id: str) -> ObjectId:
+    try:
+        return ObjectId(product_id)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid product id")
 
 
 def serialize_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Mutates in place: docs come straight from the driver and are not reused,
+    # and product queries project away any other ObjectId fields.
     if not doc:
         return doc
-    out = {**doc}
-    if out.get("_id") is not None:
-        out["id"] = str(out.pop("_id"))
-    # convert nested ObjectIds if any
-    for k, v in list(out.items()):
-        if isinstance(v, ObjectId):
-            out[k] = str(v)
-    return out
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison: our ETags cover every content-coding of the body
+    opaque = etag.removeprefix("W/")
+    return opaque in (t.strip().removeprefix("W/") for t in header.split(","))
+
+
+def not_modified(etag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    out = dict(headers or {})
+    out["ETag"] = etag
+    out.pop("content-length", None)
+    out.pop("content-type", None)
+    return Response(status_code=304, headers=out)
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    response = await call_next(request)
+    if request.method != "GET" or response.status_code != 200 or "etag" in response.headers:
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = f'W/"{xxhash.xxh64(body).hexdigest()}"'
+    headers = dict(response.headers)
+    if etag_matches(request, etag):
+        return not_modified(etag, headers)
+    headers["ETag"] = etag
+    return Response(
+        content=body,
+        status_code=response.status_code,
+        headers=headers,
+        media_type=response.media_type,
+    )
+
+
+# Registered after etag_middleware so gzip is outermost and ETags hash the
+# uncompressed body (gzip output embeds an mtime). Small payloads such as
+# /test stay below minimum_size and go out uncompressed.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+# Categories change rarely; cache the distinct list in-process.
+CATEGORIES_TTL = 60
+_cats_cache: Dict[str, Any] = {"exp": 0.0, "val": []}
+
+
+def title_key(title: str) -> str:
+    # Lower-cased copy of the title stored as title_lower; a case-sensitive
+    # anchored regex on it is a bounded range scan, unlike "$options": "i".
+    return title.lower()
+
+
+def encode_cursor(value: Any, product_id: str) -> str:
+    raw = orjson.dumps([value, product_id])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, product_id = orjson.loads(raw)
+        # The value is spliced into the filter; only scalars, never operators
+        if not isinstance(value, (int, float, str, type(None))) or not isinstance(product_id, str):
+            raise ValueError("Invalid cursor")
+        return value, ObjectId(product_id)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(sort_spec: List[Any], value: Any, oid: ObjectId) -> Dict[str, Any]:
+    field, direction = sort_spec[0]
+    op = "$gt" if direction == 1 else "$lt"
+    if field == "_id":
+        return {"_id": {op: oid}}
+    # Range operators never match null, which sorts below every number:
+    # nulls come first ascending and last descending.
+    clauses: List[Dict[str, Any]] = [{field: value, "_id": {op: oid}}]
+    if value is None:
+        if direction == 1:
+            clauses.append({field: {"$ne": None}})
+    else:
+        clauses.append({field: {op: value}})
+        if direction == -1:
+            clauses.append({field: None})
+    return {"$or": clauses}
+
+
+# $text syntax: "phrase" quotes and -negation at the start of a term. Queries
+# using them fall back to a literal title prefix regex; other punctuation
+# ("men's", "wi-fi") is tokenized fine by $text.
+_LITERAL_CHARS = re.compile(r'"|(?:^|\s)-')
+
+# Every sort ends with an _id tiebreaker so pages can be resumed by keyset.
+_SORTS: Dict[str, List[Any]] = {
+    "price_asc": [("price", 1), ("_id", 1)],
+    "price_desc": [("price", -1), ("_id", -1)],
+    "rating_desc": [("rating", -1), ("_id", -1)],
+}
+_DEFAULT_SORT: List[Any] = [("_id", 1)]
+_TEXT_SCORE = {"$meta": "textScore"}
+
+# Only the fields ProductOut needs are fetched from Mongo.
+_PRODUCT_FIELDS = {
+    "title": 1,
+    "description": 1,
+    "price": 1,
+    "category": 1,
+    "in_stock": 1,
+    "image": 1,
+    "rating": 1,
+}
 
 
 # ------------------------
 # Schemas
 # ------------------------
 class ProductCreate(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     title: str
     description: Optional[str] = None
     price: float = Field(..., ge=0)
@@ -67,6 +217,46 @@ class ProductOut(ProductCreate):
     id: str
 
 
+# ------------------------
+# Indexes
+# ------------------------
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    try:
+        # Backfill documents written before title_lower existed
+        await db["product"].update_many(
+            {"title_lower": {"$exists": False}},
+            [{"$set": {"title_lower": {"$toLower": "$title"}}}],
+        )
+    except Exception:
+        logger.exception("Could not backfill product.title_lower")
+    # Word search depends on this index; create it on its own so a conflict
+    # (a collection allows only one text index) can't block the others.
+    try:
+        await db["product"].create_index(
+            [("title", "text"), ("description", "text")],
+            weights={"title": 10, "description": 1},
+            name="product_text",
+        )
+    except Exception:
+        logger.exception("Could not create product text index; $text search will fail")
+    try:
+        await db["product"].create_indexes(
+            [
+                IndexModel([("title_lower", 1)]),
+                IndexModel([("category", 1)]),
+                IndexModel([("category", 1), ("price", 1), ("_id", 1)]),
+                IndexModel([("category", 1), ("rating", -1), ("_id", -1)]),
+                IndexModel([("price", 1), ("_id", 1)]),
+                IndexModel([("rating", -1), ("_id", -1)]),
+            ]
+        )
+    except Exception:
+        logger.exception("Could not create product indexes")
+
+
 # ------------------------
 # Seed sample data (on first run)
 # ------------------------
@@ -75,8 +265,8 @@ async def seed_products():
     if db is None:
         return
     try:
-        count = db["product"].count_documents({})
-        if count == 0:
+        existing = await db["product"].find_one({}, projection={"_id": 1})
+        if existing is None:
             sample_products = [
                 {
                     "title": "Wireless Headphones",
@@ -133,8 +323,15 @@ async def seed_products():
                     "rating": 4.1,
                 },
             ]
+            now = datetime.now(timezone.utc)
             for p in sample_products:
-                create_document("product", p)
+                p["title_lower"] = title_key(p["title"])
+                p["created_at"] = now
+                p["updated_at"] = now
+            try:
+                await db["product"].insert_many(sample_products, ordered=False)
+            except BulkWriteError:
+                pass
     except Exception:
         # Ignore seeding errors in template context
         pass
@@ -144,74 +341,147 @@ async def seed_products():
 # Routes
 # ------------------------
 @app.get("/")
-def root():
+async def root():
     return {"message": "E-Commerce Template API"}
 
 
 @app.get("/api/products", response_model=List[ProductOut])
-def list_products(
+async def list_products(
+    response: Response,
     q: Optional[str] = Query(default=None, description="Search query"),
     category: Optional[str] = Query(default=None),
     limit: int = Query(default=50, ge=1, le=100),
-    sort: Optional[str] = Query(default=None, description="price_asc | price_desc | rating_desc"),
+    sort: Optional[Literal["price_asc", "price_desc", "rating_desc"]] = Query(default=None),
+    deep: bool = Query(default=False, description="Also prefix-match descriptions for literal queries"),
+    after: Optional[str] = Query(default=None, description="X-Next-Cursor value from the previous page"),
 ):
     if db is None:
         return []
     filter_doc: Dict[str, Any] = {}
+    projection: Dict[str, Any] = dict(_PRODUCT_FIELDS)
+    sort_spec = _SORTS.get(sort)
+    text_search = False
     if q:
-        filter_doc["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-        ]
+        if _LITERAL_CHARS.search(q):
+            title_prefix = {"title_lower": {"$regex": "^" + re.escape(title_key(q))}}
+            if deep:
+                filter_doc["$or"] = [
+                    title_prefix,
+                    {"description": {"$regex": "^" + re.escape(q), "$options": "i"}},
+                ]
+            else:
+                filter_doc.update(title_prefix)
+        else:
+            filter_doc["$text"] = {"$search": q}
+            text_search = True
     if category:
         filter_doc["category"] = category
 
-    cursor = db["product"].find(filter_doc)
-
-    if sort == "price_asc":
-        cursor = cursor.sort("price", 1)
-    elif sort == "price_desc":
-        cursor = cursor.sort("price", -1)
-    elif sort == "rating_desc":
-        cursor = cursor.sort("rating", -1)
-
-    cursor = cursor.limit(limit)
-    return [serialize_doc(d) for d in cursor]
+    if sort_spec is None and text_search:
+        projection["score"] = _TEXT_SCORE
+        sort_spec = [("score", _TEXT_SCORE)]
+        keyset = False
+    else:
+        sort_spec = sort_spec or _DEFAULT_SORT
+        keyset = True
+
+    if after:
+        if not keyset:
+            raise HTTPException(status_code=400, detail="Cursor requires an explicit sort")
+        value, oid = decode_cursor(after)
+        filter_doc.setdefault("$and", []).append(keyset_filter(sort_spec, value, oid))
+
+    cursor = db["product"].find(filter_doc, projection=projection, sort=sort_spec, limit=limit)
+    docs = await cursor.to_list(length=limit)
+    out = [serialize_doc(d) for d in docs]
+    if keyset and len(out) == limit:
+        last = out[-1]
+        field = sort_spec[0][0]
+        value = last["id"] if field == "_id" else last.get(field)
+        response.headers["X-Next-Cursor"] = encode_cursor(value, last["id"])
+    # Documents were validated on write; skip re-running field validators
+    return [ProductOut.model_construct(**d) for d in out]
 
 
 @app.get("/api/products/{product_id}", response_model=ProductOut)
-def get_product(product_id: str):
+async def get_product(product_id: str, request: Request, response: Response):
     if db is None:
         raise HTTPException(status_code=404, detail="Not found")
-    try:
-        oid = ObjectId(product_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid product id")
-    doc = db["product"].find_one({"_id": oid})
+    oid = parse_product_id(product_id)
+    doc = await db["product"].find_one(
+        {"_id": oid}, projection={**_PRODUCT_FIELDS, "updated_at": 1}
+    )
     if not doc:
         raise HTTPException(status_code=404, detail="Product not found")
+    updated_at = doc.get("updated_at")
+    if updated_at is not None:
+        # Cheap validator that avoids hashing the serialized body. Motor returns
+        # naive UTC datetimes; pin the zone so .timestamp() ignores host TZ.
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        etag = f'W/"{oid}-{int(updated_at.timestamp() * 1000)}"'
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
     return serialize_doc(doc)
 
 
+@app.post("/api/products:batch", response_model=List[Optional[ProductOut]])
+async def batch_products(ids: List[str] = Body(..., max_length=100)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    oids = []
+    for i in ids:
+        try:
+            oids.append(ObjectId(i))
+        except (InvalidId, TypeError):
+            continue
+    if not oids:
+        return [None] * len(ids)
+    cursor = db["product"].find({"_id": {"$in": oids}}, projection=_PRODUCT_FIELDS)
+    docs = await cursor.to_list(length=len(oids))
+    by_id = {d["id"]: ProductOut.model_construct(**d) for d in map(serialize_doc, docs)}
+    # Preserve request order; unknown or malformed ids come back as null
+    return [by_id.get(i) for i in ids]
+
+
 @app.get("/api/categories", response_model=List[str])
-def categories():
+async def categories():
     if db is None:
         return []
-    cats = db["product"].distinct("category")
-    return sorted([c for c in cats if c])
+    now = time.monotonic()
+    if now < _cats_cache["exp"]:
+        return _cats_cache["val"]
+    cats = await db["product"].distinct("category")
+    result = sorted([c for c in cats if c])
+    _cats_cache.update(exp=now + CATEGORIES_TTL, val=result)
+    return result
 
 
 @app.post("/api/products", response_model=ProductOut)
-def create_product(payload: ProductCreate):
+async def create_product(payload: ProductCreate):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    product_id = create_document("product", payload.model_dump())
-    doc = db["product"].find_one({"_id": ObjectId(product_id)})
-    return serialize_doc(doc)
+    doc = payload.model_dump()
+    product_id = await create_document("product", {**doc, "title_lower": title_key(payload.title)})
+    if payload.category not in _cats_cache["val"]:
+        _cats_cache["exp"] = 0.0
+    # The stored document is the payload plus title_lower, so echo it back
+    doc["id"] = product_id
+    return doc
+
+
+# /test is polled by load balancers; reuse the last result for a while.
+HEALTH_TTL = 30
+_health: Dict[str, Any] = {"exp": 0.0, "val": None}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
+    now = time.monotonic()
+    if now < _health["exp"]:
+        return _health["val"]
+
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -228,7 +498,8 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, "name") else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                await db.command("ping", maxTimeMS=500)
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -242,6 +513,7 @@ def test_database():
     response["database_url"] = "✅ Set" if _os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if _os.getenv("DATABASE_NAME") else "❌ Not Set"
 
+    _health.update(exp=now + HEALTH_TTL, val=response)
     return response
 
 
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+import database
+import main
+
+
+@pytest.fixture
+def db(monkeypatch):
+    test_db = mongomock_motor.AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(main, "db", test_db)
+    monkeypatch.setattr(database, "db", test_db)
+    return test_db
+
+
+@pytest.fixture
+def client(db):
+    # Not used as a context manager, so startup seeding/indexing is skipped
+    return TestClient(main.app)
+
+
+def insert_products(db, ratings):
+    docs = [
+        {
+            "_id": ObjectId(),
+            "title": f"p{n}",
+            "price": 10.0 + n,
+            "category": "Misc",
+            "in_stock": True,
+            "rating": rating,
+        }
+        for n, rating in enumerate(ratings)
+    ]
+    asyncio.run(db["product"].insert_many(docs))
+    return docs
+
+
+def fetch_all_pages(client, params):
+    seen = []
+    after = None
+    while True:
+        query = dict(params, **({"after": after} if after else {}))
+        response = client.get("/api/products", params=query)
+        assert response.status_code == 200
+        seen.extend(p["id"] for p in response.json())
+        after = response.headers.get("x-next-cursor")
+        if not after:
+            return seen
+
+
+def test_rating_desc_pages_include_null_ratings(client, db):
+    insert_products(db, [4.2, None, 4.6, None, 4.9])
+    unpaged = [p["id"] for p in client.get("/api/products", params={"sort": "rating_desc"}).json()]
+    paged = fetch_all_pages(client, {"sort": "rating_desc", "limit": 2})
+    assert len(unpaged) == 5
+    assert paged == unpaged
+
+
+def test_ascending_cursor_on_null_value_continues_to_non_null(db):
+    docs = insert_products(db, [None, 3.0, None, 1.0])
+    last_null = max(d["_id"] for d in docs if d["rating"] is None)
+    sort_spec = [("rating", 1), ("_id", 1)]
+    keyset = main.keyset_filter(sort_spec, None, last_null)
+    found = asyncio.run(db["product"].find(keyset, sort=sort_spec).to_list(length=None))
+    assert [d["rating"] for d in found] == [1.0, 3.0]
+
+
+@pytest.mark.parametrize("value", [{"$ne": None}, {"$regex": "."}, [1, 2]])
+def test_cursor_rejects_non_scalar_values(client, db, value):
+    cursor = main.encode_cursor(value, str(ObjectId()))
+    response = client.get("/api/products", params={"sort": "price_asc", "after": cursor})
+    assert response.status_code == 400
+
+
+def test_literal_query_prefix_matches_title_case_insensitively(client, db):
+    client.post(
+        "/api/products",
+        json={"title": '"Retro" USB-C Lamp', "price": 9.5, "category": "Home"},
+    )
+    response = client.get("/api/products", params={"q": '"retro" usb'})
+    assert [p["title"] for p in response.json()] == ['"Retro" USB-C Lamp']
+    assert "title_lower" not in response.json()[0]
+
+
+@pytest.mark.parametrize("value", [None, 123, "not-an-id"])
+def test_py_object_id_rejects_invalid_input(value):
+    with pytest.raises(ValueError):
+        main.PyObjectId.validate(value)
+
+
+def test_product_etag_ignores_host_timezone(client, db, monkeypatch):
+    product_id = client.post(
+        "/api/products", json={"title": "Mug", "price": 5.0, "category": "Home"}
+    ).json()["id"]
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    utc_etag = client.get(f"/api/products/{product_id}").headers["etag"]
+    monkeypatch.setenv("TZ", "Asia/Tokyo")
+    time.tzset()
+    try:
+        assert client.get(f"/api/products/{product_id}").headers["etag"] == utc_etag
+    finally:
+        monkeypatch.undo()
+        time.tzset()